@@ -1,9 +1,32 @@
 from .utils import *
-from .cosmology import *
 from .params import Params
 from .GPconfig import GPConfig
-from .database import Data 
-from .likelihood import Likelihood
-from .sampler import Sampler
-from .kernel import *
-from .likelihood import Likelihood_GP
\ No newline at end of file
+from .database import Data
+
+# The cosmology, likelihood, sampler and kernel modules pull in the compiled cosmology backend and the
+# sampling packages, so they and their classes are only imported on first access (PEP 562)
+_submodules = ['cosmology', 'likelihood', 'sampler', 'kernel']
+_cosmologies = ['Cosmology', 'Cosmology_base', 'wCDM', 'LCDM', 'CPL', 'CPL3', 'XCDM', 'kwCDM', 'kLCDM', 'kCPL', 'kCPL3', 'kXCDM']
+_lazy = {**{name: 'cosmology' for name in _cosmologies},
+         'Likelihood': 'likelihood',
+         'Likelihood_GP': 'likelihood',
+         'Sampler': 'sampler',
+         'Kernel': 'kernel',
+         }
+
+__all__ = ['load_data_once', 'nan_to_zero', 'temporarily_false', 'Params', 'GPConfig', 'Data'] + list(_lazy)
+
+
+def __getattr__(name):
+    import importlib
+    if name in _submodules:
+        return importlib.import_module(f'.{name}', __name__)
+    if name in _lazy:
+        value = getattr(importlib.import_module(f'.{_lazy[name]}', __name__), name)
+        globals()[name] = value
+        return value
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_lazy) | set(_submodules))
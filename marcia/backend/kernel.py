@@ -1,4 +1,6 @@
-from numba import jit
+import ctypes
+from numba import jit, njit
+from numba.extending import get_cython_function_address
 import numpy as np
 from scipy.integrate import odeint
 
@@ -26,4 +28,90 @@ def gdMdef(tau, l1, nu):
     # * sp.special.gamma(1./4. + nu/2.)
     return A, D 
 
-    
\ No newline at end of file
+    
+
+# Bind the scalar Bessel function from scipy's cython_special so that it can be called from nopython code
+# The ctypes pointer is a dynamic global, so the functions using it cannot be cached to disk
+_kv = ctypes.CFUNCTYPE(ctypes.c_double, ctypes.c_double, ctypes.c_double)(get_cython_function_address('scipy.special.cython_special', '__pyx_fuse_1kv'))
+
+@njit
+def gMbasis(tau, nu, l1, gnu):
+    # Scalar version of the full basis function, nu = 0.0 flags the squared exponential kernel
+    # gnu holds the gamma function factors (gamma(nu/2 - 1/4), gamma(nu/2 + 1/4), gamma(nu + 1/2), gamma(nu))
+    x = np.abs(tau)
+    if nu == 0.0:
+        return np.exp(- (x**2.)/(2. * l1**2.))
+    A = (nu / (2. * np.pi * l1**2.))**(1./8.) * (gnu[0]/gnu[1])**(1./2.) * (gnu[2]/gnu[3])**(1./4.)
+    B = 2.**(5./4. - nu/2.) / gnu[0]
+    C = (2. * nu)**(1./2.) * tau**2. / l1
+    return A**2. * B * C**(nu/2. - 1./4.) * _kv(2., 3. * x / l1) / np.pi
+
+@njit
+def gMMdef_gh(tau_values, l2_values, l1_values, nu1, nu2, gnu1, gnu2, nodes, weights):
+    # Gauss-Hermite convolution of the two basis functions on the (tau, l2, l1) grid
+    integrals = np.zeros((len(tau_values), len(l2_values), len(l1_values)))
+    for k in range(len(tau_values)):
+        tau = tau_values[k]
+        for j in range(len(l2_values)):
+            l2 = l2_values[j]
+            for i in range(len(l1_values)):
+                l1 = l1_values[i]
+                # quadrature of length scales, sets the centre and width of the integrand
+                l1l2_quad = l1**2. + l2**2.
+                width = np.sqrt(2. * l1**2. * l2**2. / l1l2_quad)
+                centre = tau * l1**2. / l1l2_quad
+                result = 0.
+                for n in range(len(nodes)):
+                    u = centre + width * nodes[n]
+                    result += weights[n] * np.exp(nodes[n]**2.) * gMbasis(u, nu1, l1, gnu1) * gMbasis(tau - u, nu2, l2, gnu2)
+                integrals[k, j, i] = width * result
+    return integrals
+
+@njit
+def gMMdef_split(tau_values, l2_values, l1_values, nu1, nu2, gnu1, gnu2, lag_nodes, lag_weights, ts_p, ts_q, ts_weights):
+    # Convolution of two Matern basis functions on the (tau, l2, l1) grid, split at the kinks u = 0 and u = tau
+    # The two tails decay exponentially at the rate 3/l1 + 3/l2 and use a Gauss-Laguerre rule, the segment 
+    # between the kinks uses a tanh-sinh rule, whose nodes ts_p and ts_q = 1 - ts_p cluster at both ends
+    integrals = np.zeros((len(tau_values), len(l2_values), len(l1_values)))
+    for k in range(len(tau_values)):
+        tau = tau_values[k]
+        a = min(0., tau)
+        b = max(0., tau)
+        x = np.abs(tau)
+        for j in range(len(l2_values)):
+            l2 = l2_values[j]
+            for i in range(len(l1_values)):
+                l1 = l1_values[i]
+                scale = 1. / (3. / l1 + 3. / l2)
+                tails = 0.
+                for n in range(len(lag_nodes)):
+                    t = scale * lag_nodes[n]
+                    tails += lag_weights[n] * np.exp(lag_nodes[n]) * (gMbasis(a - t, nu1, l1, gnu1) * gMbasis(tau - a + t, nu2, l2, gnu2) 
+                                                                     + gMbasis(b + t, nu1, l1, gnu1) * gMbasis(tau - b - t, nu2, l2, gnu2))
+                # the basis functions only depend on |u| and |tau - u|, which are x*p and x*q on the segment,
+                # which is empty at tau = 0 where the basis functions are not defined
+                middle = 0.
+                for n in range(len(ts_p) if x > 0. else 0):
+                    middle += ts_weights[n] * gMbasis(x * ts_p[n], nu1, l1, gnu1) * gMbasis(x * ts_q[n], nu2, l2, gnu2)
+                integrals[k, j, i] = scale * tails + x * middle
+    return integrals
+
+@njit(cache=True)
+def _grid_cell(grid, x):
+    # Lower index and weight of the cell containing x, the edge cells are used to extrapolate outside the grid
+    i = np.searchsorted(grid, x) - 1
+    i = min(max(i, 0), len(grid) - 2)
+    return i, (x - grid[i]) / (grid[i+1] - grid[i])
+
+@njit(fastmath=True, cache=True)
+def trilinear_batch(grid_tau, grid_l2, grid_l1, values, tau_flat, l2_const, l1_const, out):
+    # Linear interpolation on the (tau, l2, l1) grid for a vector of tau at fixed scale lengths,
+    # equivalent to RegularGridInterpolator(method='linear', fill_value=None)
+    j, wj = _grid_cell(grid_l2, l2_const)
+    i, wi = _grid_cell(grid_l1, l1_const)
+    for n in range(len(tau_flat)):
+        k, wk = _grid_cell(grid_tau, tau_flat[n])
+        c0 = (values[k, j, i] * (1. - wi) + values[k, j, i+1] * wi) * (1. - wj) + (values[k, j+1, i] * (1. - wi) + values[k, j+1, i+1] * wi) * wj
+        c1 = (values[k+1, j, i] * (1. - wi) + values[k+1, j, i+1] * wi) * (1. - wj) + (values[k+1, j+1, i] * (1. - wi) + values[k+1, j+1, i+1] * wi) * wj
+        out[n] = c0 * (1. - wk) + c1 * wk
+    return out
@@ -34,21 +34,30 @@ class Data:
         self.y = {}
         self.covar = {}
 
+        self._bm_shapes = None
+        self._bm_buffer = None
+        self._bm_slices = []
+
     def __block_matrix__(self,matrices):
-        size = sum(matrix.shape[0] for matrix in matrices)
-        result = np.zeros((size, size))
+        # The block layout only depends on the sizes of the datasets, so the slices and the buffer
+        # are built once and the diagonal blocks are overwritten in place on the following calls.
+        # The returned matrix is shared between calls, copy it if it has to be kept.
+        shapes = tuple(matrix.shape[0] for matrix in matrices)
+        if shapes != self._bm_shapes:
+            size = sum(shapes)
+            self._bm_buffer = np.zeros((size, size))
+            self._bm_slices = []
+            start = 0
+            for n in shapes:
+                self._bm_slices.append(slice(start, start + n))
+                start += n
+            self._bm_shapes = shapes
 
         # Fill the resulting matrix with the input matrices in a block diagonal manner
-        row_start = 0
-        col_start = 0
-        for matrix in matrices:
-            row_end = row_start + matrix.shape[0]
-            col_end = col_start + matrix.shape[1]
-            result[row_start:row_end, col_start:col_end] = matrix
-            row_start = row_end
-            col_start = col_end
+        for sl, matrix in zip(self._bm_slices, matrices):
+            np.copyto(self._bm_buffer[sl, sl], matrix)
         
-        return result
+        return self._bm_buffer
 
     def __call__(self, paramdict=None):
         if paramdict is None:
@@ -139,14 +148,19 @@ class Data:
         assert len(x) == len(y) == covar.shape[0] == covar.shape[1]
         return x,y,covar
     
+    @load_data_once
+    def get_data_growth(self, filename):
+        return loadtxt(os.path.join(__datapath__, 'Growth Rate', filename))
+
     def get_growth(self):
-        datafile = loadtxt(os.path.join(__datapath__, 'Growth Rate',f'GR{self.file_fs8}.txt' if self.file_fs8 > 0 else 'GR.txt')) 
+        datafile = self.get_data_growth(f'GR{self.file_fs8}.txt' if self.file_fs8 > 0 else 'GR.txt')
         x = datafile[:,0]
         y = datafile[:,1]
         covar = np.diag(datafile[:,2]**2)
         assert len(x) == len(y) == covar.shape[0] == covar.shape[1]
         return x,y,covar
     
+    @load_data_once
     def get_Lya(self):
         datafile = loadtxt(os.path.join(__datapath__, 'Lyman-alpha','DmH.txt'))
         datafile2 = loadtxt(os.path.join(__datapath__, 'Lyman-alpha','CovDmh.txt')) 
@@ -156,8 +170,12 @@ class Data:
         assert len(x) == len(y) == covar.shape[0] == covar.shape[1]
         return x,y,covar
     
+    @load_data_once
+    def get_data_GRB(self):
+        return loadtxt(os.path.join(__datapath__, 'GRB','GRB.txt'),usecols=(1,2,3,4,5))
+
     def get_GRB(self):
-        datafile = loadtxt(os.path.join(__datapath__, 'GRB','GRB.txt'),usecols=(1,2,3,4,5))
+        datafile = self.get_data_GRB()
         z = datafile[:,0]
         S_b = datafile[:,1]
         sigma_S_b = datafile[:,2]
@@ -180,13 +198,15 @@ class Data:
         y = mu
         return x,y,covar
 
+    @load_data_once
     def get_SNE(self):
         data = loadtxt(os.path.join(__datapath__, 'Pantheon_E','SNE.txt'))
         corr = loadtxt(os.path.join(__datapath__, 'Pantheon_E','SSNE.txt'))
         x = data[:,0]
         y = 1/data[:,1]
         sigma = data[:,2]
-        covar = sigma * corr * sigma.T
+        # corr is the correlation matrix, so the covariance is diag(sigma) @ corr @ diag(sigma)
+        covar = corr * np.outer(sigma, sigma)
         return x,y,covar
     
     
@@ -206,6 +226,7 @@ class Data:
         z, lnFUV, lnFUV_err, lnFX, lnFX_err, _, _ ,_,_= self.get_QSO_data()
         return z, lnFUV, lnFUV_err, lnFX, lnFX_err
 
+    @load_data_once
     def get_QSO(self):
         x,_,_,_,_,y,sigma,_,_ = self.get_QSO_data()
         covar = np.diag(sigma**2)
@@ -215,6 +236,7 @@ class Data:
         _,_,_,_,_,_,_,ra,dec = self.get_QSO_data()
         return ra,dec
 
+    @load_data_once
     def get_CMB_planck_TT(self):
         # This is the Planck 2018 data special case where we want 
         # to use the TT data only
@@ -225,6 +247,7 @@ class Data:
         covar = np.diag(sigma**2)
         return x,y,covar
     
+    @load_data_once
     def get_CMB_planck_EE(self):
         # This is the Planck 2018 data special case where we want 
         # to use the EE data only
@@ -235,6 +258,7 @@ class Data:
         covar = np.diag(sigma**2)
         return x,y,covar
     
+    @load_data_once
     def get_CMB_planck_TE(self):
         # This is the Planck 2018 data special case where we want 
         # to use the TE data only
@@ -10,14 +10,36 @@ from scipy.interpolate import RegularGridInterpolator
 import time
 import configparser
 
-from multiprocessing import Pool
-import itertools
+from multiprocessing import Pool, cpu_count
 import pickle
 
 from marcia import Data
 from marcia import GPconfig
 from marcia.backend import kernel as kbackend
 
+# Memoized cross kernel grids, keyed on the (nu, grid) signature of the pair of tasks. The cache is shared by 
+# all the Kernel instances of the session, so a grid built for one GP model is reused by the next one
+_KCMM_CACHE = {}
+
+def _gMMdef_chunk(args):
+    """Worker for the cross kernel grid, integrates a contiguous chunk of tau values"""
+    tau_chunk, l1_values, l2_values, nu1, nu2, gnu1, gnu2, rule = args
+    if nu1 == 0.0 and nu2 == 0.0:
+        return kbackend.gMMdef_gh(tau_chunk, l2_values, l1_values, nu1, nu2, gnu1, gnu2, *rule)
+    return kbackend.gMMdef_split(tau_chunk, l2_values, l1_values, nu1, nu2, gnu1, gnu2, *rule)
+
+class _TransposedInterp(object):
+    """
+        Cross kernel of the exchanged pair of tasks. It queries the wrapped interpolator with the two scale 
+        lengths swapped, instead of building an interpolator on the transposed grid.
+        """
+    def __init__(self, interp):
+        self.interp = interp
+
+    def __call__(self, xi):
+        xi = np.asarray(xi, dtype=np.float64)
+        return self.interp(xi[..., [0, 2, 1]])
+
 
 class Kernel(object):
 
@@ -44,6 +66,10 @@ class Kernel(object):
 
         # Read the nus from the config file
         self.nus = MTGP['nus']
+        # The gamma function factors of the basis functions only depend on nu, so they are computed once
+        self._gnu_coeffs = {}
+        for nu in set(self.nus):
+            self._gamma_coeffs(nu)
 
         # The data contains the list/lists of x-axes
         self.data = data
@@ -55,6 +81,14 @@ class Kernel(object):
         print(f'Kernels: {self.models}')
 
         self.setup_kernel_data()
+
+        self._KcMM_checked = False
+        self._KcMM_swapped = False
+        self._KcMM_grid = None
+        self._KcMM_values = None
+
+        # The assembled covariance matrices of the last two parameter sets, keyed on the raw bytes of the parameters
+        self._Cov_Mat_memo = []
         
         # To check if the  number of datasets is equal to the number of models
         if len(self.data) != self.nmodel:
@@ -83,32 +117,40 @@ class Kernel(object):
         else:
             # Cross covariance is not defined for different kernels
             raise ValueError('Error: Multi kernel cross covariance matrix is not defined, only multi task for same kernel is defined')
-        
-        # To initialise the total covariance matrix as a dictionary which is a function of the kernel parameters
-        self.CovMat = {}
 
     def setup_kernel_data(self):
-        """Define kernels and data in a dictionary."""
-        self.kernel_f = {}
-        self.data_f = {}
-        for i in range(self.nTasks):
-            self.kernel_f[f't_{i}'] = self.models[i]
-            self.data_f[f't_{i}'] = self.data[i]
+        """Define kernels and data as lists indexed by the task."""
+        self.kernel_f = list(self.models)
+        self.data_f = [np.asarray(x, dtype=np.float64) for x in self.data]
 
-        # Define the data_tau dictionary, which contains the difference between the x-axes of the datasets
-        self.data_tau = {}
+        # The slices of each task in the total covariance matrix, which is written in place on every call
+        self._row_slices = []
+        start = 0
+        for x in self.data_f:
+            self._row_slices.append(slice(start, start + len(x)))
+            start += len(x)
+
+        # Define data_tau[i][j], which contains the difference between the x-axes of the datasets i and j
+        # The lower pairs are the transposed upper ones with the sign flipped
+        # The interpolated cross kernel of the upper Matern pairs is queried with the flattened tau, a view of data_tau
+        self.data_tau = [[None]*self.nTasks for _ in range(self.nTasks)]
+        self._tau_flat = [[None]*self.nTasks for _ in range(self.nTasks)]
         for i in range(self.nTasks):
-            for j in range(self.nTasks):
-                self.data_tau[f't_{i}{j}'] = self.data_f[f't_{i}'][:, None] - self.data_f[f't_{j}'][None, :]
+            for j in range(i, self.nTasks):
+                tau = self.data_f[i][:, None] - self.data_f[j][None, :]
+                self.data_tau[i][j] = tau
+                self.data_tau[j][i] = np.ascontiguousarray(-tau.T)
+                if i < j and self.kernel_f[i] == self.kernel_f[j] and self.kernel_f[i] in ['M92', 'M72', 'M52', 'M32']:
+                    self._tau_flat[i][j] = tau.ravel()
+
+        self._K = np.zeros((start, start))
         
     def __call__(self, pars):
         """
             It returns the covariance matrix for the GP model for the given paramters 
         """
         # We set the self-scaling in the likelihood function and here simply create the dictionary of parameters
-        # self.CovMat_all = np.block([[ pars[i,0]* pars[j,0]*self.CovMat[f't_{i}{j}']([pars[i,1]* pars[j,1], self.data_tau[f't_{i}{j}']]) for i in range(self.nTasks)] for j in range(self.nTasks)])
-
-        self.CovMat_all = self.CovMat_all(pars)
+        self.CovMat_all = self.Cov_Mat(pars)
         return self.CovMat_all
         
     # Define the special fucntions needed for the generalised matern kernel
@@ -118,6 +160,15 @@ class Kernel(object):
     def _spgamma_(self, x):
         return sp.special.gamma(x)
 
+    def _gamma_coeffs(self, nu):
+        """Returns (gamma(nu/2 - 1/4), gamma(nu/2 + 1/4), gamma(nu + 1/2), gamma(nu)), memoized on nu"""
+        if nu not in self._gnu_coeffs:
+            if nu == 0.0: # not used by the squared exponential kernel
+                self._gnu_coeffs[nu] = (1., 1., 1., 1.)
+            else:
+                self._gnu_coeffs[nu] = (self._spgamma_(nu/2. - 1./4.), self._spgamma_(nu/2. + 1./4.), self._spgamma_(nu + 1./2.), self._spgamma_(nu))
+        return self._gnu_coeffs[nu]
+
     def gMdef(self, tau, nu, l1):
         """ 
             Defines the basis function for the GP model and returns a vector
@@ -129,8 +180,9 @@ class Kernel(object):
             return np.exp(- (x**2.)/(2. * l1**2.))
         else: # Generalised Matern kernel
             A, B, C = kbackend.gMdef(tau,l1,nu)
-            A = A * (self._spgamma_(nu/2. - 1./4.)/self._spgamma_(nu/2. + 1./4.))**(1./2.) * (self._spgamma_(nu + 1./2.)/self._spgamma_(nu))**(1./4.)
-            B = B / self._spgamma_(nu/2. - 1./4.)
+            gnu = self._gamma_coeffs(nu)
+            A = A * (gnu[0]/gnu[1])**(1./2.) * (gnu[2]/gnu[3])**(1./4.)
+            B = B / gnu[0]
             return A**2. * B * C**(nu/2. - 1./4.) * self._spkv_(tau,l1) / np.pi
 
         
@@ -139,9 +191,10 @@ class Kernel(object):
             Defines the derivative of the basis function for the GP model and returns a vector
             Finally I define only ine single function for the basis function"""
         B = sp.special.kv(1./4. * (5. - 2. * nu), np.sqrt(2.) * np.sqrt(nu) * np.sqrt(tau**2.) / l1)
-        C = np.sqrt(self._spgamma_(1./2. + nu) / self._spgamma_(nu))
+        gnu = self._gamma_coeffs(nu)
+        C = np.sqrt(gnu[2] / gnu[3])
         A, D = kbackend.gdMdef(tau, l1, nu)
-        D = D * self._spgamma_(1./4. + nu/2.) 
+        D = D * gnu[1]
         return A * B * C / D
     
     def gMMdef_integrand(self, params):
@@ -149,18 +202,63 @@ class Kernel(object):
         gMMdef_integrand = lambda u: self.gMdef(u, self.nu1, l1) * self.gMdef(tau - u, self.nu2, l2)
         integral, _ = quad(gMMdef_integrand, -np.inf, np.inf, epsabs=1e-8, epsrel=1e-8, limit=100)
         return integral
-    
+
+    def gMMdef_quadrature(self, tau_values, l1_values, l2_values, n_nodes=64, n_tail=16):
+        """
+            Evaluates the convolution of the basis functions on the full (tau, l2, l1) grid with fixed order rules.
+            For two squared exponential basis functions a Gauss-Hermite rule of n_nodes is centred and scaled on 
+            their product, and the e^{-u^2} weight is undone explicitly.
+            The Matern basis functions have kinks at u = 0 and u = tau and exponential tails, which a single 
+            Gauss-Hermite rule misses by a few percent. The integral is split at the kinks, with an n_tail Gauss-Laguerre 
+            rule on each tail and an (n_nodes + 1) point tanh-sinh rule in between. Against adaptive quadrature the 
+            relative error is below 1e-7 on most of the default grid and at most a few 1e-4 where a scale length 
+            is close to 0.01.
+            The tau axis is split into one chunk per process, at most one per tau value, and each worker returns 
+            a dense slab.
+            """
+        if self.nu1 == 0.0 and self.nu2 == 0.0:
+            rule = np.polynomial.hermite.hermgauss(n_nodes)
+        else:
+            lag_nodes, lag_weights = np.polynomial.laguerre.laggauss(n_tail)
+            # tanh-sinh steps on [-3.2, 3.2], beyond which the nodes are closer to the ends than double precision
+            t = np.linspace(-3.2, 3.2, n_nodes + 1)
+            ts_p = 1. / (1. + np.exp(- np.pi * np.sinh(t)))
+            ts_q = 1. / (1. + np.exp(np.pi * np.sinh(t)))
+            ts_weights = (t[1] - t[0]) * np.pi * np.cosh(t) * ts_p * ts_q
+            rule = (lag_nodes, lag_weights, ts_p, ts_q, ts_weights)
+        nproc = min(cpu_count(), len(tau_values))
+        chunks = np.array_split(tau_values, nproc)
+        gnu1, gnu2 = self._gamma_coeffs(self.nu1), self._gamma_coeffs(self.nu2)
+        args = [(chunk, l1_values, l2_values, float(self.nu1), float(self.nu2), gnu1, gnu2, rule) for chunk in chunks]
+        with Pool(nproc) as pool:
+            integrals = pool.map(_gMMdef_chunk, args)
+        return np.concatenate(integrals, axis=0)
 
     def KcMM(self, l1_values, l2_values, tau_values):
         """
             Defines the cross kernel function for the GP model and returns the covariance matrix
+            The integral grids are memoized at module level on (nu1, nu2, l1 range, l2 range, tau range), so that 
+            kernels sharing the same specification do not recompute the convolution
             """
-        integrals = np.zeros((len(tau_values), len(l2_values), len(l1_values)))
-        params = list(itertools.product(tau_values, l2_values, l1_values))
-        with Pool() as pool:
-            integrals = pool.map(self.gMMdef_integrand, params)
-        integrals = np.array(integrals).reshape((len(tau_values), len(l2_values), len(l1_values)))
-        return RegularGridInterpolator((tau_values, l2_values, l1_values), integrals, bounds_error=False, fill_value=None)
+        key = (self.nu1, self.nu2, l1_values[0], l1_values[-1], len(l1_values), l2_values[0], l2_values[-1], len(l2_values), tau_values[0], tau_values[-1], len(tau_values))
+        if key in _KCMM_CACHE:
+            return _KCMM_CACHE[key][0]
+
+        # Exchanging the two tasks only swaps the length scale axes of the convolution, so the stored 
+        # interpolator is reused through a wrapper and the grid is kept as a transposed view
+        key_swap = (self.nu2, self.nu1, l2_values[0], l2_values[-1], len(l2_values), l1_values[0], l1_values[-1], len(l1_values), tau_values[0], tau_values[-1], len(tau_values))
+        if key_swap in _KCMM_CACHE:
+            KcMM_swap, integrals_swap = _KCMM_CACHE[key_swap]
+            KcMM_int = KcMM_swap.interp if isinstance(KcMM_swap, _TransposedInterp) else _TransposedInterp(KcMM_swap)
+            _KCMM_CACHE[key] = (KcMM_int, np.transpose(integrals_swap, (0, 2, 1)))
+            return KcMM_int
+
+        # The grid is stored in single precision to halve the memory traffic of the interpolation,
+        # the grid coordinates stay in double precision
+        integrals = self.gMMdef_quadrature(tau_values, l1_values, l2_values).astype(np.float32, copy=False)
+        KcMM_int = RegularGridInterpolator((tau_values, l2_values, l1_values), integrals, bounds_error=False, fill_value=None)
+        _KCMM_CACHE[key] = (KcMM_int, integrals)
+        return KcMM_int
 
     def matern(self, nu, x1, x2, l_s):
         """
@@ -172,8 +270,13 @@ class Kernel(object):
             The input x1 and x2 are the x-axes of the data points and l_s is the scale length
             """
         # Here to-do the nu = half-integer cases -- Sandeep
-        # This fucntion returns nan when x1 = x2, so we need to replace nan with zero
-        return np.nan_to_num((2.**(1.-nu)/sp.special.gamma(nu)) * ((np.sqrt(2.*nu) * np.abs(x1-x2))/l_s)**nu * sp.special.kv(nu, (np.sqrt(2.*nu) * np.abs(x1-x2))/l_s)) + np.eye(len(x1)) 
+        # The expression is nan when x1 = x2, where the kernel tends to 1, so only the separated pairs are 
+        # evaluated and the coincident ones are filled with the analytic limit
+        r = np.sqrt(2.*nu) * np.abs(x1-x2) / l_s
+        result = np.ones(r.shape)
+        separated = r > 0.
+        result[separated] = (2.**(1.-nu)/sp.special.gamma(nu)) * r[separated]**nu * sp.special.kv(nu, r[separated])
+        return result
 
     def kernel(self, model, params, x1, x2=None, mat_nu=None):
         """ 
@@ -188,18 +291,42 @@ class Kernel(object):
         if model == 'matern' and mat_nu is not None:
             return params[0]**2. * self.matern(mat_nu, x1[:, None], x2[None, :], params[1])
 
-    def cross_kernel(self, model1, model2, params1, params2, x1, x2):
+    def set_KcMM_grid(self):
+        """
+            Extracts the grid and values of a linear KcMM interpolator, which are then evaluated directly by the 
+            compiled interpolation in the backend, with the values in single precision. Returns False if the 
+            interpolator cannot be handled this way, the result is recorded so that the check is not repeated 
+            on every call
+            The interpolator of an exchanged pair of tasks is unwrapped, and its scale lengths are swapped when 
+            the grid is queried
+            """
+        self._KcMM_checked = True
+        interp = self.KcMM_int.interp if isinstance(self.KcMM_int, _TransposedInterp) else self.KcMM_int
+        if isinstance(interp, RegularGridInterpolator) and interp.method == 'linear':
+            self._KcMM_swapped = interp is not self.KcMM_int
+            self._KcMM_grid = tuple(np.ascontiguousarray(grid, dtype=np.float64) for grid in interp.grid)
+            self._KcMM_values = np.ascontiguousarray(interp.values, dtype=np.float32)
+            # The interpolator is rebuilt on the same single precision arrays, so that a double precision grid 
+            # loaded from the pickle is not kept alongside them
+            interp = RegularGridInterpolator(self._KcMM_grid, self._KcMM_values, method='linear', bounds_error=interp.bounds_error, fill_value=interp.fill_value)
+            self.KcMM_int = _TransposedInterp(interp) if self._KcMM_swapped else interp
+            return True
+        return False
+
+    def cross_kernel(self, model1, model2, params1, params2, x1, x2, tau=None):
         """ 
             Defines the cross kernel function for the GP model and returns the covariance matrix
+            tau is an optional precomputed flattened x1 - x2, which is passed as is to the compiled interpolation 
+            of the Matern cross kernel
             """
         if model1 == model2:
             model_here = model1
-            # difference between x1 and x2
-            x1x2 = x1[:, None]-x2[None, :]
             # product of the sigmas
             sig1sig2 = params1[0] * params2[0]
 
             if model_here == 'SE': # Squared Exponential kernel
+                # difference between x1 and x2
+                x1x2 = x1[:, None]-x2[None, :]
                 # product of the scale lengths
                 l1l2 = params1[1] * params2[1]
                 # quadrature of length scales
@@ -208,8 +335,18 @@ class Kernel(object):
                 return sig1sig2 * np.exp(- (x1x2**2.)/(l1l2_quad)) * np.sqrt(2. * l1l2 / l1l2_quad)
             elif model_here in ['M92', 'M72', 'M52', 'M32']: 
                 # the pickle file name is the 'KcMM_M92_M92.pkl' where the first M92 is the model1 and the second M92 is the model2
-                lambda_func = np.vectorize(lambda x: self.KcMM_int([x, params1[1], params2[1]]))
-                return sig1sig2 * np.array(lambda_func(x1x2))
+                shape = (len(x1), len(x2))
+                if tau is None:
+                    tau = (x1[:, None]-x2[None, :]).ravel()
+                if self._KcMM_values is not None or (not self._KcMM_checked and self.set_KcMM_grid()):
+                    l_a, l_b = (params2[1], params1[1]) if self._KcMM_swapped else (params1[1], params2[1])
+                    out = kbackend.trilinear_batch(*self._KcMM_grid, self._KcMM_values, tau, float(l_a), float(l_b), np.empty(tau.size))
+                    return sig1sig2 * out.reshape(shape)
+                points = np.empty((tau.size, 3))
+                points[:, 0] = tau
+                points[:, 1] = params1[1]
+                points[:, 2] = params2[1]
+                return sig1sig2 * self.KcMM_int(points).reshape(shape)
                 
         else:
             raise ValueError(f'Error: Cross kernel not defined for {model1} and {model2}')
@@ -218,21 +355,37 @@ class Kernel(object):
     def Cov_Mat(self, params):
         """ 
             Defines the covariance matrix for the GP model and returns the covariance matrix 
+            The matrices of the last two parameter sets are memoized and returned without a copy, so they are 
+            read-only and have to be copied before being modified in place
+            """
+        params = np.ascontiguousarray(params, dtype=np.float64)
+        key = (params.shape, params.tobytes())
+        for memo_key, K in self._Cov_Mat_memo:
+            if memo_key == key:
+                return K
+        # Each memoized matrix is assembled in a matrix of its own
+        K = self.assemble_Cov_Mat(params, out=np.empty_like(self._K))
+        K.setflags(write=False)
+        self._Cov_Mat_memo = [(key, K)] + self._Cov_Mat_memo[:1]
+        return K
+
+    def assemble_Cov_Mat(self, params, out=None):
+        """ 
+            Assembles the covariance matrix for the given parameters in out, without memoization. By default out
+            is a buffer that is overwritten by the next call
             """
-        # To create a dictionary of covariance matrices for each task
+        # To write the covariance matrices of each task and their cross correlations directly into the total 
+        # covariance matrix, the lower blocks are computed and the upper ones are mirrored
+        K = self._K if out is None else out
+        rs = self._row_slices
+        kernel_f, data_f, tau_flat = self.kernel_f, self.data_f, self._tau_flat
         for i in range(self.nTasks):
-            for j in range(self.nTasks):
-                if i == j:
-                    self.CovMat[f't_{i}{j}'] = self.kernel(self.kernel_f[f't_{i}'], params[i], self.data_f[f't_{i}'], mat_nu=self.nus[i])
-                elif i < j:
-                    self.CovMat[f't_{i}{j}'] = np.transpose(self.cross_kernel(self.kernel_f[f't_{i}'], self.kernel_f[f't_{j}'], params[i], params[j], self.data_f[f't_{i}'], self.data_f[f't_{j}']))
-                else:
-                    self.CovMat[f't_{i}{j}'] = np.transpose(self.CovMat[f't_{j}{i}'])
+            K[rs[i], rs[i]] = self.kernel(kernel_f[i], params[i], data_f[i], mat_nu=self.nus[i])
+            for j in range(i+1, self.nTasks):
+                K[rs[j], rs[i]] = np.transpose(self.cross_kernel(kernel_f[i], kernel_f[j], params[i], params[j], data_f[i], data_f[j], tau=tau_flat[i][j]))
+                K[rs[i], rs[j]] = np.transpose(K[rs[j], rs[i]])
         
-        # To join all the covariance matrices defined above in the dictionaries into one big covariance matrix taking into account the cross correlations between the datasets 
-        CovMat_all = np.block([[ self.CovMat[f't_{i}{j}'] for i in range(self.nTasks)] for j in range(self.nTasks)])
-        
-        return CovMat_all
+        return K
    
     def make_cross_kernel(self):
         """This function is used to create and save the interpolated cross kernel for the multi task GP model"""
@@ -240,18 +393,11 @@ class Kernel(object):
         print(f'Constructing the cross covariance matrix for the multi task GP model with the {self.models[0]} kernel ... ')
         self.nu1 = self.nu2 = self.nus[0]
         # The following has to be changed to modify the resolution of the cross covariance matrix
-        l1_values = np.linspace(0.01, 20, 100)
-        l2_values = np.linspace(0.01, 20, 100)
+        # the same grid is used for both scale lengths
+        l_values = np.linspace(0.01, 20, 100)
         tau_values = np.linspace(-10, 10, 100)
 
-        integrals = np.zeros((len(tau_values), len(l2_values), len(l1_values)))
-        params = list(itertools.product(tau_values, l2_values, l1_values))
-        with Pool() as pool:
-            integrals = pool.map(self.gMMdef_integrand, params)
-        integrals = np.array(integrals).reshape((len(tau_values), len(l2_values), len(l1_values)))
-
-
-        KcMM_int = RegularGridInterpolator((tau_values, l2_values, l1_values), integrals, bounds_error=False, fill_value=None)
+        KcMM_int = self.KcMM(l_values, l_values, tau_values)
         with open(self.file_path, 'wb') as f:
             pickle.dump(KcMM_int, f)
         print(f'Cross covariance matrix saved in {self.file_path}')
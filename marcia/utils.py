@@ -3,12 +3,15 @@ from numba import jit
 from functools import wraps
 
 def load_data_once(func):
-    data = None
+    # The result is cached on the arguments following the instance, so a loader
+    # without arguments is evaluated once and one taking a file is evaluated once per file
+    data = {}
+    @wraps(func)
     def wrapper(*args, **kwargs):
-        nonlocal data
-        if data is None:
-            data = func(*args, **kwargs)
-        return data
+        key = args[1:] + tuple(sorted(kwargs.items()))
+        if key not in data:
+            data[key] = func(*args, **kwargs)
+        return data[key]
     return wrapper
 
 @jit(nopython=True)
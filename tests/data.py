@@ -20,4 +20,33 @@ class TestDATA(unittest.TestCase):
         assert cov_cc_bao.shape[0] == cov_cc.shape[0] + cov_bao.shape[0]
         assert cov_cc_bao.shape[1] == cov_cc.shape[1] + cov_bao.shape[1]
     
-    
\ No newline at end of file
+    def test_block_matrix(self):
+        _,_,cov_cc = self.data_cc({})
+        _,_,cov_bao = self.data_bao({})
+        _,_,cov_cc_bao = self.data_cc_bao({})
+        n = cov_cc.shape[0]
+        assert np.allclose(cov_cc_bao[:n, :n], cov_cc)
+        assert np.allclose(cov_cc_bao[n:, n:], cov_bao)
+        assert np.all(cov_cc_bao[:n, n:] == 0) and np.all(cov_cc_bao[n:, :n] == 0)
+        # The buffer is reused on the following calls with the same layout
+        _,_,cov_cc_bao_2 = self.data_cc_bao({})
+        assert cov_cc_bao_2 is cov_cc_bao
+
+    def test_growth_files(self):
+        # The growth rate table is loaded once per file
+        data_gr0, data_gr1 = Data('GR', file_fs8=0), Data('GR', file_fs8=1)
+        x0, _, _ = data_gr0.get_growth()
+        x1, _, _ = data_gr1.get_growth()
+        assert len(x0) == 24 and len(x1) == 16
+        assert Data('GR', file_fs8=1).get_data_growth('GR1.txt') is data_gr1.get_data_growth('GR1.txt')
+
+    def test_SNE_covariance(self):
+        _,_,cov_sne = Data('SNE')({})
+        data = np.loadtxt(f'{real_path}/../Data/Pantheon_E/SNE.txt')
+        corr = np.loadtxt(f'{real_path}/../Data/Pantheon_E/SSNE.txt')
+        sigma = data[:,2]
+        # The correlation matrix is scaled by sigma on both sides
+        assert np.allclose(np.diag(cov_sne), sigma**2)
+        assert np.allclose(cov_sne, corr * np.outer(sigma, sigma))
+        assert np.allclose(cov_sne, cov_sne.T)
+    
@@ -0,0 +1,21 @@
+import sys
+import os 
+import subprocess
+real_path = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(f'{real_path}/../')
+import unittest
+
+class TestIMPORT(unittest.TestCase):
+    def run_fresh(self, code):
+        # The lazy attributes are only tested in a fresh interpreter, before anything else imported the submodules
+        return subprocess.run([sys.executable, '-c', f'import marcia\n{code}'], cwd=f'{real_path}/../', capture_output=True, text=True)
+
+    def test_submodules(self):
+        result = self.run_fresh('print(marcia.kernel.Kernel.__name__, marcia.cosmology.LCDM.__name__)')
+        assert result.returncode == 0, result.stderr
+        assert result.stdout.split() == ['Kernel', 'LCDM']
+
+    def test_dir(self):
+        result = self.run_fresh('from marcia import Kernel\nfrom marcia import *\nnames = dir(marcia)\nprint(len(names) == len(set(names)), "kernel" in names, "LCDM" in names)')
+        assert result.returncode == 0, result.stderr
+        assert result.stdout.split() == ['True', 'True', 'True']
@@ -0,0 +1,175 @@
+import sys
+import os 
+import numpy as np
+import scipy as sp
+import scipy.special
+real_path = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(f'{real_path}/../')
+from marcia.kernel import Kernel
+from marcia import kernel as kernel_module
+from marcia.backend import kernel as kbackend
+from scipy.interpolate import RegularGridInterpolator
+import unittest
+
+class TestKcMM(unittest.TestCase):
+    def setUp(self):
+        # The cross kernel grids do not need the data or the config file
+        self.kernel = object.__new__(Kernel)
+        kernel_module._KCMM_CACHE.clear()
+        self.kernel._gnu_coeffs = {}
+        self.kernel.nu1 = self.kernel.nu2 = 0.0
+        self.l1_values = np.linspace(0.1, 5, 6)
+        self.l2_values = np.linspace(0.5, 10, 5)
+        self.tau_values = np.linspace(-5, 5, 7)
+
+    def test_quadrature_SE(self):
+        integrals = self.kernel.gMMdef_quadrature(self.tau_values, self.l1_values, self.l2_values)
+        tau, l2, l1 = np.meshgrid(self.tau_values, self.l2_values, self.l1_values, indexing='ij')
+        l1l2_quad = l1**2. + l2**2.
+        arr = np.sqrt(2. * np.pi * l1**2. * l2**2. / l1l2_quad) * np.exp(- tau**2. / (2. * l1l2_quad))
+        assert np.allclose(integrals, arr)
+
+    def test_quadrature_matern(self):
+        tau_values, l1_values, l2_values = np.array([-3.7, 1.3, 6.1]), np.array([0.3, 2.2]), np.array([1.1, 7.5])
+        for nu in [2.5, 3.5, 4.5]:
+            self.kernel.nu1 = self.kernel.nu2 = nu
+            integrals = self.kernel.gMMdef_quadrature(tau_values, l1_values, l2_values)
+            arr = np.array([[[self.kernel.gMMdef_integrand((tau, l1, l2)) for l1 in l1_values] for l2 in l2_values] for tau in tau_values])
+            assert np.allclose(integrals, arr, rtol=1e-5, atol=0.)
+
+    def test_cache(self):
+        self.kernel.nu1 = self.kernel.nu2 = 3.5
+        KcMM_int = self.kernel.KcMM(self.l1_values, self.l2_values, self.tau_values)
+        assert self.kernel.KcMM(self.l1_values, self.l2_values, self.tau_values) is KcMM_int
+        KcMM_swap = self.kernel.KcMM(self.l2_values, self.l1_values, self.tau_values)
+        assert np.allclose(KcMM_swap([1., 2., 0.3]), KcMM_int([1., 0.3, 2.]))
+        # The cache is shared by all the kernel instances
+        other = object.__new__(Kernel)
+        other._gnu_coeffs = {}
+        other.nu1 = other.nu2 = 3.5
+        assert other.KcMM(self.l1_values, self.l2_values, self.tau_values) is KcMM_int
+
+    def test_cache_swap(self):
+        # With different nu the convolution is not symmetric in the scale lengths
+        self.kernel.nu1, self.kernel.nu2 = 2.5, 4.5
+        self.kernel.KcMM(self.l1_values, self.l2_values, self.tau_values)
+        self.kernel.nu1, self.kernel.nu2 = 4.5, 2.5
+        KcMM_swap = self.kernel.KcMM(self.l2_values, self.l1_values, self.tau_values)
+        assert isinstance(KcMM_swap, kernel_module._TransposedInterp)
+        kernel_module._KCMM_CACHE.clear()
+        KcMM_int = self.kernel.KcMM(self.l2_values, self.l1_values, self.tau_values)
+        tau, l2, l1 = np.meshgrid(self.tau_values, self.l1_values, self.l2_values, indexing='ij')
+        points = np.stack([tau, l2, l1], axis=-1)
+        assert np.allclose(KcMM_swap(points), KcMM_int(points), rtol=1e-6)
+        assert np.allclose(KcMM_swap([1.2, 2.7, 0.9]), KcMM_int([1.2, 2.7, 0.9]), rtol=1e-6)
+
+class TestTrilinear(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(42)
+        self.grid = (np.linspace(-10, 10, 9), np.sort(rng.uniform(0.01, 20, 6)), np.sort(rng.uniform(0.01, 20, 7)))
+        self.values = rng.normal(size=(9, 6, 7))
+        self.interp = RegularGridInterpolator(self.grid, self.values, method='linear', bounds_error=False, fill_value=None)
+
+    def compare(self, tau, l2, l1):
+        out = kbackend.trilinear_batch(*self.grid, self.values, tau, l2, l1, np.empty(tau.size))
+        arr = self.interp(np.stack([tau, np.full(tau.size, l2), np.full(tau.size, l1)], axis=-1))
+        assert np.allclose(out, arr, rtol=1e-12, atol=1e-12)
+
+    def test_nodes(self):
+        self.compare(self.grid[0], self.grid[1][2], self.grid[2][4])
+        self.compare(self.grid[0], self.grid[1][-1], self.grid[2][0])
+
+    def test_between_nodes(self):
+        tau = 0.5 * (self.grid[0][1:] + self.grid[0][:-1])
+        self.compare(tau, 0.5 * (self.grid[1][1] + self.grid[1][2]), 0.3 * self.grid[2][3] + 0.7 * self.grid[2][4])
+
+    def test_outside(self):
+        tau = np.array([-14., -10.5, 0.3, 10.2, 17.])
+        self.compare(tau, self.grid[1][0] - 1., self.grid[2][-1] + 3.)
+        self.compare(tau, self.grid[1][-1] + 0.5, self.grid[2][0] / 2.)
+
+    def test_single_precision_grid(self):
+        # The compiled path and the interpolator share one single precision copy of the grid values
+        kernel = object.__new__(Kernel)
+        kernel.KcMM_int = self.interp
+        assert kernel.set_KcMM_grid()
+        assert kernel._KcMM_values.dtype == np.float32
+        assert kernel.KcMM_int.values is kernel._KcMM_values
+        assert np.allclose(kernel.KcMM_int([[1.5, 3., 8.]]), self.interp([[1.5, 3., 8.]]), rtol=1e-6)
+
+    def test_transposed(self):
+        # The interpolator of an exchanged pair of tasks is evaluated by the compiled path with swapped scale lengths
+        kernel = object.__new__(Kernel)
+        kernel._KcMM_checked, kernel._KcMM_values = False, None
+        kernel.KcMM_int = kernel_module._TransposedInterp(self.interp)
+        x1, x2 = np.array([0.1, 0.5, 2.]), np.array([0.3, 1.])
+        K = kernel.cross_kernel('M72', 'M72', [1., 2.], [1.5, 4.], x1, x2)
+        assert kernel._KcMM_values is not None and kernel._KcMM_swapped
+        tau = (x1[:, None] - x2[None, :]).ravel()
+        assert np.allclose(K.ravel(), 1.5 * self.interp(np.stack([tau, np.full(tau.size, 4.), np.full(tau.size, 2.)], axis=-1)), rtol=1e-6)
+
+    def test_fallback_checked_once(self):
+        # An interpolator that the compiled path cannot handle is checked once and then called directly
+        kernel = object.__new__(Kernel)
+        kernel._KcMM_checked, kernel._KcMM_values = False, None
+        kernel.KcMM_int = RegularGridInterpolator(self.grid, self.values, method='nearest', bounds_error=False, fill_value=None)
+        calls = []
+        set_KcMM_grid = kernel.set_KcMM_grid
+        kernel.set_KcMM_grid = lambda: calls.append(1) or set_KcMM_grid()
+        x1, x2 = np.array([0.1, 0.5, 2.]), np.array([0.3, 1.])
+        for _ in range(3):
+            K = kernel.cross_kernel('M72', 'M72', [1., 2.], [1.5, 4.], x1, x2)
+        assert len(calls) == 1
+        tau = (x1[:, None] - x2[None, :]).ravel()
+        assert np.allclose(K.ravel(), 1.5 * kernel.KcMM_int(np.stack([tau, np.full(tau.size, 2.), np.full(tau.size, 4.)], axis=-1)))
+
+class TestCovMat(unittest.TestCase):
+    def setUp(self):
+        self.kernel = object.__new__(Kernel)
+        self.kernel.models, self.kernel.nTasks, self.kernel.nus = ['SE', 'SE'], 2, [0., 0.]
+        self.kernel.data = [np.linspace(0., 2., 5), np.linspace(0.5, 3., 4)]
+        self.kernel.setup_kernel_data()
+        self.kernel._Cov_Mat_memo = []
+        self.calls = []
+        assemble_Cov_Mat = self.kernel.assemble_Cov_Mat
+        self.kernel.assemble_Cov_Mat = lambda params, out=None: self.calls.append(1) or assemble_Cov_Mat(params, out=out)
+        self.params = [np.array([[1., 0.5], [0.8, 1.2]]), np.array([[1.1, 0.5], [0.8, 1.2]]), np.array([[1., 0.7], [0.6, 1.2]])]
+
+    def test_memo(self):
+        K = self.kernel.Cov_Mat(self.params[0])
+        assert self.kernel.Cov_Mat(self.params[0].copy()) is K
+        assert len(self.calls) == 1
+        self.kernel.Cov_Mat(self.params[1])
+        assert self.kernel.Cov_Mat(self.params[0]) is K
+        assert len(self.calls) == 2
+        # Only the last two parameter sets are kept
+        self.kernel.Cov_Mat(self.params[2])
+        self.kernel.Cov_Mat(self.params[0])
+        assert len(self.calls) == 4
+
+    def test_read_only(self):
+        K = self.kernel.Cov_Mat(self.params[0])
+        arr = K.copy()
+        with self.assertRaises(ValueError):
+            K[0, 0] = 10.
+        # A modified copy does not change the memoized matrix
+        K_copy = self.kernel.Cov_Mat(self.params[0]).copy()
+        K_copy += 1.
+        assert np.array_equal(self.kernel.Cov_Mat(self.params[0]), arr)
+        assert np.allclose(arr, self.kernel.assemble_Cov_Mat(self.params[0]))
+
+class TestMatern(unittest.TestCase):
+    def setUp(self):
+        self.kernel = object.__new__(Kernel)
+        self.x = np.linspace(0.1, 2., 8)
+
+    def test_matern(self):
+        nu, l_s = 3.5, 0.8
+        K = self.kernel.matern(nu, self.x[:, None], self.x[None, :], l_s)
+        r = np.sqrt(2.*nu) * np.abs(self.x[0] - self.x[3]) / l_s
+        assert np.allclose(np.diag(K), 1.)
+        assert np.allclose(K[0, 3], (2.**(1.-nu)/sp.special.gamma(nu)) * r**nu * sp.special.kv(nu, r))
+        assert np.allclose(K, K.T)
+        # nu = 1/2 is the absolute exponential kernel
+        assert np.allclose(self.kernel.matern(0.5, self.x[:, None], self.x[None, :], l_s), np.exp(- np.abs(self.x[:, None] - self.x[None, :]) / l_s))
+